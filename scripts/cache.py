@@ -0,0 +1,82 @@
+"""
+File-backed response cache for the data pipeline.
+=================================================
+Each entry is a JSON blob under the cache directory named
+<endpoint>_<md5 of params>.json, holding the call params, the result and a
+fetched_at timestamp. Entries older than their TTL are treated as misses.
+"""
+
+import functools
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import orjson
+
+
+class FileCache:
+    """JSON file cache keyed by (endpoint, params).
+
+    enabled=False bypasses reads (results are still written), and any entry
+    whose params contain a value in `refresh` is re-fetched."""
+
+    def __init__(self, cache_dir, enabled=True, refresh=()):
+        self.cache_dir = Path(cache_dir)
+        self.enabled = enabled
+        self.refresh = set(refresh)
+
+    def _path(self, endpoint, params):
+        key = hashlib.md5(orjson.dumps(params)).hexdigest()
+        return self.cache_dir / f"{endpoint}_{key}.json"
+
+    def get(self, endpoint, params, ttl):
+        """Return the cached value, or None on a miss, expiry or forced refresh."""
+        if not self.enabled or self.refresh.intersection(params):
+            return None
+        path = self._path(endpoint, params)
+        try:
+            entry = orjson.loads(path.read_bytes())
+            fetched_at = datetime.fromisoformat(entry["fetched_at"].replace("Z", "+00:00"))
+        except (OSError, ValueError, KeyError):
+            return None
+        if datetime.now(timezone.utc) - fetched_at > ttl:
+            return None
+        return entry["value"]
+
+    def set(self, endpoint, params, value):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(endpoint, params)
+        entry = {
+            "endpoint": endpoint,
+            "params": params,
+            "fetched_at": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            "value": value,
+        }
+        # Write then rename so concurrent readers never see a partial file
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(orjson.dumps(entry, option=orjson.OPT_SERIALIZE_NUMPY, default=str))
+        os.replace(tmp_path, path)
+
+    def cached(self, ttl_days=0, ttl_hours=0, key_args=None, cache_if=None):
+        """Decorator caching a function's JSON-serialisable result.
+
+        key_args: number of leading positional args forming the cache key
+                  (default: all positional args).
+        cache_if: optional predicate; results failing it are not stored."""
+        ttl = timedelta(days=ttl_days, hours=ttl_hours)
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                params = list(args if key_args is None else args[:key_args])
+                hit = self.get(func.__name__, params, ttl)
+                if hit is not None:
+                    return hit
+                value = func(*args, **kwargs)
+                if cache_if is None or cache_if(value):
+                    self.set(func.__name__, params, value)
+                return value
+            return wrapper
+        return decorator
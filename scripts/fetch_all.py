@@ -21,31 +21,114 @@ Methodology:
   Zakat = Value * Fund Zakaatable % * 2.5%
 """
 
-import json
-import math
+import argparse
+import functools
+import logging
 import os
+import queue
 import sys
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
 import requests
 import yfinance as yf
+from yfinance.data import YfData
+import numpy as np
+import orjson
 import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import FileCache
+
+logger = logging.getLogger("zakat")
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = BASE_DIR / "data"
 
+# Concurrent balance sheet fetches (kept modest to avoid Yahoo rate limiting)
+MAX_FETCH_WORKERS = 8
+
+# Yahoo's quote endpoint accepts many symbols per request. It rejects calls without
+# a cookie + crumb, so it is requested through yfinance's authenticated data layer.
+QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+QUOTE_BATCH_SIZE = 20
+
+# Session for direct (non-Yahoo) HTTP calls, i.e. the FX API request; it exists
+# for its retry policy: throttling (429) and server errors are retried with
+# exponential backoff. Yahoo traffic (yf.Ticker and the batched quotes) goes through
+# yfinance's own curl_cffi session, which impersonates a browser's TLS fingerprint
+# and is far less likely to be throttled or blocked than a plain requests.Session.
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "Mozilla/5.0"
+SESSION.mount("https://", HTTPAdapter(
+    max_retries=Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    ),
+))
+
+# Attempts per yfinance call (yfinance uses its own session, so SESSION's retries don't apply)
+YF_RETRY_ATTEMPTS = 3
+
+# Pacing for Yahoo requests made through yfinance, shared by all fetch workers
+YF_MAX_CONCURRENT = 4
+YF_MIN_INTERVAL = 0.25  # seconds between request starts
+_yf_slots = threading.BoundedSemaphore(YF_MAX_CONCURRENT)
+_yf_pace_lock = threading.Lock()
+_yf_next_start = 0.0
+
+# On-disk response cache; configured from the CLI in main()
+CACHE = FileCache(DATA_DIR / ".cache")
+
+# How long names and reporting currency from ticker.info are reused by the fast_info path
+STATIC_INFO_TTL = timedelta(days=30)
+
+# Consecutive runs with an empty quarterly balance sheet before a ticker is treated
+# as annual-only, and how long that lasts before quarterly is probed first again
+QUARTERLY_MISSES_BEFORE_ANNUAL = 3
+PREFERRED_BS_TTL = timedelta(days=90)
+
+
+def read_json(path):
+    """Parse a JSON file with orjson (reads bytes directly, no text decode step)."""
+    return orjson.loads(path.read_bytes())
+
+
+def write_json(path, obj):
+    """Write obj as indented JSON (kept human-readable since data/*.json is committed)."""
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY, default=str))
+
 
 # ──────────────────────────────────────────────
 # 1. FX RATES
 # ──────────────────────────────────────────────
 
-def fetch_fx_rates():
+def fetch_fx_rates(run_timestamp):
     """Fetch live FX rates from ExchangeRate-API (free, no key needed)."""
-    print("\n[1/4] Fetching live FX rates...")
+    logger.info("\n[1/4] Fetching live FX rates...")
+    output = _download_fx_rates(run_timestamp)
+    rates = output["rates"]
+
+    out_path = DATA_DIR / "fx_rates.json"
+    write_json(out_path, output)
+
+    logger.info(f"  Saved {len(rates)} currency rates to {out_path}")
+    return rates
+
+
+@CACHE.cached(ttl_hours=24, key_args=0)
+def _download_fx_rates(fetched_at):
+    """Download USD-based rates (plus GBp/GBX); cached for a day."""
     url = "https://open.er-api.com/v6/latest/USD"
-    resp = requests.get(url, timeout=15)
+    resp = SESSION.get(url, timeout=15)
     resp.raise_for_status()
     data = resp.json()
 
@@ -62,56 +145,198 @@ def fetch_fx_rates():
     output = {
         "base": "USD",
         "rates": rates,
-        "fetched_at": datetime.utcnow().isoformat() + "Z",
+        "fetched_at": fetched_at,
     }
-
-    out_path = DATA_DIR / "fx_rates.json"
-    with open(out_path, "w") as f:
-        json.dump(output, f, indent=2)
-
-    print(f"  Saved {len(rates)} currency rates to {out_path}")
-    return rates
+    return output
 
 
 # ──────────────────────────────────────────────
 # 2. BALANCE SHEET FETCHER
 # ──────────────────────────────────────────────
 
-def safe_get(series, *field_names, default=0.0):
+@functools.lru_cache(maxsize=None)
+def _spaced(name):
+    """Split a PascalCase field name into yfinance's alternate spaced naming,
+    e.g. CashAndCashEquivalents -> Cash And Cash Equivalents.
+    Memoised, so each field name is only converted once per process."""
+    spaced = ""
+    for i, ch in enumerate(name):
+        if ch.isupper() and i > 0:
+            spaced += " "
+        spaced += ch
+    return spaced
+
+
+def _column_to_dict(col):
+    """Balance sheet column -> {field: float} with NaN rows dropped, so lookups
+    are plain dict.get calls instead of pandas indexing."""
+    values = col.to_numpy(dtype="float64", na_value=np.nan).tolist()
+    return {name: val for name, val in zip(col.index.tolist(), values) if val == val}
+
+
+def safe_get(fields, *field_names, default=0.0):
     """Try each field name in order, return first non-null numeric value.
+    fields is a dict from _column_to_dict (NaNs already dropped).
     Handles both PascalCase and space-separated yfinance field names."""
     for name in field_names:
-        # Try exact match first
-        if name in series.index:
-            val = series[name]
-            if val is not None and not (isinstance(val, float) and math.isnan(val)):
-                return float(val)
-        # Try space-separated version: "CashAndCashEquivalents" -> "Cash And Cash Equivalents"
-        spaced = ""
-        for i, ch in enumerate(name):
-            if ch.isupper() and i > 0:
-                spaced += " "
-            spaced += ch
-        if spaced != name and spaced in series.index:
-            val = series[spaced]
-            if val is not None and not (isinstance(val, float) and math.isnan(val)):
-                return float(val)
+        val = fields.get(name)
+        if val is not None:
+            return val
+        spaced = _spaced(name)
+        if spaced != name:
+            val = fields.get(spaced)
+            if val is not None:
+                return val
     return default
 
 
-def fetch_company(ticker_symbol):
-    """Fetch balance sheet and market data for a single ticker."""
-    ticker = yf.Ticker(ticker_symbol)
+def _fetch_quote_chunk(chunk):
+    """One quote request for up to QUOTE_BATCH_SIZE symbols -> list of raw quote results,
+    or None if the request failed (HTTP error such as 401, non-JSON body, or an API error)."""
+    params = {"symbols": ",".join(chunk), "formatted": "false"}
+    try:
+        data = _yf_retry(lambda: YfData().get_raw_json(QUOTE_URL, params=params, timeout=15))
+        response = data["quoteResponse"]
+        if response.get("error"):
+            raise RuntimeError(response["error"])
+        return response["result"]
+    except Exception as e:
+        logger.warning(f"  WARNING: batched quote fetch failed for {len(chunk)} tickers: {e}")
+        return None
+
+
+def fetch_quotes_batched(tickers):
+    """Fetch market cap, price and currencies for many tickers in batched requests.
+    Batches are requested concurrently.
+    Returns {ticker: info-like dict}; tickers missing from the response are omitted
+    so fetch_company can fall back to ticker.info for them."""
+    quotes = {}
+    chunks = [tickers[i:i + QUOTE_BATCH_SIZE] for i in range(0, len(tickers), QUOTE_BATCH_SIZE)]
+    if not chunks:
+        return quotes
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(chunks))) as ex:
+        for items in ex.map(_fetch_quote_chunk, chunks):
+            if items is None:
+                failed += 1
+                continue
+            for q in items:
+                quotes[q["symbol"]] = {
+                    "marketCap": q.get("marketCap"),
+                    "currency": q.get("currency", "USD"),
+                    "financialCurrency": q.get("financialCurrency", q.get("currency", "USD")),
+                    "currentPrice": q.get("regularMarketPrice"),
+                    "previousClose": q.get("regularMarketPreviousClose"),
+                    "sharesOutstanding": q.get("sharesOutstanding"),
+                    "longName": q.get("longName"),
+                    "shortName": q.get("shortName"),
+                }
+
+    logger.info(f"  Fetched quotes for {len(quotes)}/{len(tickers)} tickers")
+    if failed:
+        logger.warning(f"  WARNING: {failed}/{len(chunks)} quote batches failed; those tickers fall back to per-ticker lookups")
+    return quotes
+
+
+def _yf_pace():
+    """Block until the next Yahoo request may start: at most one start per
+    YF_MIN_INTERVAL across all worker threads, so the pool can't burst into 429s."""
+    global _yf_next_start
+    with _yf_pace_lock:
+        now = time.monotonic()
+        wait = _yf_next_start - now
+        _yf_next_start = max(now, _yf_next_start) + YF_MIN_INTERVAL
+    if wait > 0:
+        time.sleep(wait)
+
+
+def _yf_retry(fetch, retry_empty=False):
+    """Call a yfinance accessor, paced and limited to YF_MAX_CONCURRENT in flight,
+    backing off 1s, 2s, ... between failed attempts (e.g. rate limiting).
+    yfinance hides throttling on the balance sheet accessors and returns an empty
+    DataFrame instead, so retry_empty=True treats an empty result as a failure too;
+    the last (empty) result is returned. Re-raises the last error."""
+    for attempt in range(YF_RETRY_ATTEMPTS):
+        last = attempt == YF_RETRY_ATTEMPTS - 1
+        try:
+            with _yf_slots:
+                _yf_pace()
+                result = fetch()
+        except Exception:
+            if last:
+                raise
+        else:
+            if not (retry_empty and (result is None or result.empty)) or last:
+                return result
+        time.sleep(2 ** attempt)
+
+
+def _cache_static_info(ticker_symbol, info):
+    """Remember the fields fast_info lacks (names, reporting currency) from a full info dict."""
+    static = {
+        "longName": info.get("longName"),
+        "shortName": info.get("shortName"),
+        "financialCurrency": info.get("financialCurrency"),
+    }
+    if static["financialCurrency"]:
+        CACHE.set("static_info", [ticker_symbol], static)
+
+
+def _fast_info(ticker, ticker_symbol):
+    """Info-like dict built from ticker.fast_info plus the cached static fields.
+    Returns None (so the caller uses ticker.info) when the reporting currency isn't
+    cached yet, or fast_info lacks share count, currency or price."""
+    static = CACHE.get("static_info", [ticker_symbol], STATIC_INFO_TTL)
+    if not static or not static.get("financialCurrency"):
+        # Cold cache: one ticker.info call gets everything (and fills the cache),
+        # which is cheaper than fast_info followed by ticker.info
+        return None
 
-    # Get info first for market cap and currencies
     try:
-        info = ticker.info
+        fi = ticker.fast_info
+        shares = fi.shares
+        currency = fi.currency
+        last_price = fi.last_price
     except Exception:
-        info = {}
+        return None
+    if not shares or not currency or not last_price:
+        return None
+
+    # Derive market cap here rather than using fi.market_cap, whose units depend on
+    # whether it came from shares * price (pence for GBp listings) or info (pounds)
+    market_cap = shares * last_price
+    if currency in ("GBp", "GBX"):
+        market_cap /= 100
+
+    return {
+        "marketCap": market_cap,
+        "currency": currency,
+        "financialCurrency": static["financialCurrency"],
+        "currentPrice": last_price,
+        "longName": static.get("longName"),
+        "shortName": static.get("shortName"),
+    }
+
+
+def _market_data(ticker, ticker_symbol, quote_info):
+    """Name, market cap, price and currencies for a ticker. Never cached across runs:
+    prices and market caps must match the run's computed_at."""
+    # ticker.info is yfinance's slowest call, so only use it when neither the
+    # quote nor fast_info has what we need
+    info = quote_info or _fast_info(ticker, ticker_symbol)
+    if not info:
+        try:
+            info = _yf_retry(lambda: ticker.info)
+            _cache_static_info(ticker_symbol, info)
+        except Exception:
+            info = {}
 
     market_cap = info.get("marketCap") or 0
     trading_currency = info.get("currency", "USD")
-    financial_currency = info.get("financialCurrency", trading_currency)
+    # Without a reported currency, assume the listing's currency in its pounds form,
+    # never pence (GBp would make the FX factor GBP/GBp = 0.01)
+    financial_currency = info.get("financialCurrency") or _mcap_currency(trading_currency)
     current_price = info.get("currentPrice") or info.get("previousClose") or 0
     shares_outstanding = info.get("sharesOutstanding") or 0
     long_name = info.get("longName") or info.get("shortName") or ticker_symbol
@@ -120,39 +345,77 @@ def fetch_company(ticker_symbol):
     if not market_cap and shares_outstanding and current_price:
         market_cap = shares_outstanding * current_price
 
-    # Prefer quarterly balance sheet (more recent), fall back to annual
-    bs = None
-    bs_type = "quarterly"
-    try:
-        qbs = ticker.quarterly_balance_sheet
-        if qbs is not None and not qbs.empty:
-            bs = qbs
-    except Exception:
-        pass
+    return {
+        "long_name": long_name,
+        "market_cap": market_cap,
+        "trading_currency": trading_currency,
+        "financial_currency": financial_currency,
+        "current_price": current_price,
+    }
 
-    if bs is None:
-        bs_type = "annual"
+
+def fetch_company(ticker_symbol, quote_info=None):
+    """Fetch balance sheet and market data for a single ticker.
+    quote_info is the ticker's entry from fetch_quotes_batched; ticker.info is
+    only fetched when it is missing. Market data is always fresh, while the
+    balance sheet may come from the on-disk cache."""
+    ticker = yf.Ticker(ticker_symbol)
+    company = {"ticker": ticker_symbol, **_market_data(ticker, ticker_symbol, quote_info)}
+
+    sheet = fetch_balance_sheet(ticker_symbol, ticker)
+    if sheet.get("error"):
+        company.update(error=sheet["error"], zakaatable_pct=25.0, fallback=True)  # fallback estimate
+        return company
+
+    company.update(sheet)
+    del company["provisional"]
+    company["fallback"] = False
+    return company
+
+
+@CACHE.cached(ttl_days=7, key_args=1,
+              cache_if=lambda sheet: not sheet.get("error") and not sheet.get("provisional"))
+def fetch_balance_sheet(ticker_symbol, ticker):
+    """Zakaatable assets and deductible liabilities from the latest balance sheet.
+    Cached for a week, since balance sheets only change quarterly.
+    Returns {"error": ...} when no usable balance sheet is available. An annual sheet
+    used only because this run's quarterly probe came back empty is marked
+    "provisional" and isn't cached, so a flaky probe can't pin it for a week."""
+    # Prefer quarterly balance sheet (more recent), fall back to annual. Each probe
+    # is a separate request, so tickers whose quarterly sheet has come back empty on
+    # several consecutive runs try annual first. One empty probe isn't enough:
+    # yfinance also returns an empty frame on transient failures (429s, timeouts).
+    quarterly_misses = CACHE.get("quarterly_misses", [ticker_symbol], PREFERRED_BS_TTL) or 0
+    annual_only = quarterly_misses >= QUARTERLY_MISSES_BEFORE_ANNUAL
+    bs_order = ("annual", "quarterly") if annual_only else ("quarterly", "annual")
+    bs = None
+    bs_type = None
+    quarterly_found = None  # None if quarterly wasn't probed
+    for kind in bs_order:
+        sheet = None
         try:
-            abs_ = ticker.balance_sheet
-            if abs_ is not None and not abs_.empty:
-                bs = abs_
+            sheet = _yf_retry(
+                lambda: ticker.quarterly_balance_sheet if kind == "quarterly" else ticker.balance_sheet,
+                retry_empty=True,
+            )
         except Exception:
             pass
+        found = sheet is not None and not sheet.empty
+        if kind == "quarterly":
+            quarterly_found = found
+        if found:
+            bs, bs_type = sheet, kind
+            break
+
+    if quarterly_found is False:
+        CACHE.set("quarterly_misses", [ticker_symbol], quarterly_misses + 1)
+    elif quarterly_found and quarterly_misses:
+        CACHE.set("quarterly_misses", [ticker_symbol], 0)
 
     if bs is None or bs.empty:
-        return {
-            "ticker": ticker_symbol,
-            "long_name": long_name,
-            "market_cap": market_cap,
-            "trading_currency": trading_currency,
-            "financial_currency": financial_currency,
-            "current_price": current_price,
-            "error": "No balance sheet data available",
-            "zakaatable_pct": 25.0,  # fallback estimate
-            "fallback": True,
-        }
+        return {"error": "No balance sheet data available"}
 
-    latest = bs.iloc[:, 0]
+    latest = _column_to_dict(bs.iloc[:, 0])
     bs_date = str(bs.columns[0].date()) if hasattr(bs.columns[0], "date") else str(bs.columns[0])
 
     # ── ZAKAATABLE ASSETS ──
@@ -201,25 +464,10 @@ def fetch_company(ticker_symbol):
     all_zero = (cash_sti == 0 and receivables == 0 and inventory == 0
                 and other_current == 0 and payables == 0 and current_debt == 0)
     if all_zero:
-        return {
-            "ticker": ticker_symbol,
-            "long_name": long_name,
-            "market_cap": market_cap,
-            "trading_currency": trading_currency,
-            "financial_currency": financial_currency,
-            "current_price": current_price,
-            "error": "Balance sheet data all empty/NaN",
-            "zakaatable_pct": 25.0,
-            "fallback": True,
-        }
+        return {"error": "Balance sheet data all empty/NaN"}
 
     return {
-        "ticker": ticker_symbol,
-        "long_name": long_name,
-        "market_cap": market_cap,
-        "trading_currency": trading_currency,
-        "financial_currency": financial_currency,
-        "current_price": current_price,
+        "provisional": bs_type == "annual" and not annual_only,
         "bs_date": bs_date,
         "bs_type": bs_type,
         "assets": {
@@ -247,49 +495,56 @@ def fetch_company(ticker_symbol):
         "net_zakaatable_broad": net_zakaatable_broad,
         "net_zakaatable_assets_only": net_zakaatable_assets_only,
         "error": None,
-        "fallback": False,
     }
 
 
+def _fetch_company_safe(ticker_symbol, quote_info=None):
+    """Worker wrapper: never raises, so one bad ticker can't poison the pool."""
+    try:
+        return fetch_company(ticker_symbol, quote_info)
+    except Exception as e:
+        return {
+            "ticker": ticker_symbol,
+            "error": str(e),
+            "zakaatable_pct": 25.0,
+            "fallback": True,
+        }
+
+
 def fetch_all_balance_sheets(tickers):
-    """Fetch balance sheets for all tickers with rate limiting."""
-    print(f"\n[2/4] Fetching balance sheets for {len(tickers)} unique tickers...")
-    results = {}
-    errors = []
+    """Fetch balance sheets for all tickers concurrently.
 
-    for i, t in enumerate(tickers):
-        print(f"  [{i+1}/{len(tickers)}] {t}...", end=" ", flush=True)
+    Fetches are network-bound, so a thread pool gives near-linear speedup.
+    MAX_FETCH_WORKERS caps concurrent requests to stay within Yahoo's rate limits."""
+    logger.info(f"\n[2/4] Fetching balance sheets for {len(tickers)} unique tickers...")
+    quotes = fetch_quotes_batched(tickers)
+    fetched = {}
+    errors = []
 
-        try:
-            data = fetch_company(t)
-            results[t] = data
-            if data.get("error"):
-                print(f"WARNING: {data['error']}")
-                errors.append((t, data["error"]))
-            else:
-                print(f"OK (zakaatable assets: {data['net_zakaatable']:,.0f})")
-        except Exception as e:
-            print(f"ERROR: {e}")
-            results[t] = {
-                "ticker": t,
-                "error": str(e),
-                "zakaatable_pct": 25.0,
-                "fallback": True,
-            }
-            errors.append((t, str(e)))
-
-        if i < len(tickers) - 1:
-            time.sleep(1.5)
+    if tickers:
+        with ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(tickers))) as ex:
+            futures = {ex.submit(_fetch_company_safe, t, quotes.get(t)): t for t in tickers}
+            for i, fut in enumerate(as_completed(futures)):
+                t = futures[fut]
+                data = fut.result()
+                fetched[t] = data
+                if data.get("error"):
+                    logger.warning(f"  [{i+1}/{len(tickers)}] {t}... WARNING: {data['error']}")
+                    errors.append((t, data["error"]))
+                else:
+                    logger.info(f"  [{i+1}/{len(tickers)}] {t}... OK (zakaatable assets: {data['net_zakaatable']:,.0f})")
+
+    # Key by ticker in input order so the saved JSON is deterministic
+    results = {t: fetched[t] for t in tickers}
 
     out_path = DATA_DIR / "balance_sheets.json"
-    with open(out_path, "w") as f:
-        json.dump(results, f, indent=2, default=str)
-    print(f"\n  Saved balance sheet data to {out_path}")
+    write_json(out_path, results)
+    logger.info(f"\n  Saved balance sheet data to {out_path}")
 
     if errors:
-        print(f"\n  {len(errors)} tickers had issues:")
+        logger.info(f"\n  {len(errors)} tickers had issues:")
         for t, e in errors:
-            print(f"    {t}: {e}")
+            logger.info(f"    {t}: {e}")
 
     return results
 
@@ -298,65 +553,108 @@ def fetch_all_balance_sheets(tickers):
 # 3. ZAKAT COMPUTATION
 # ──────────────────────────────────────────────
 
-def _convert_and_calc_pct(net_val, market_cap, fin_curr, trade_curr, fx_rates):
-    """Convert net_zakaatable to market cap currency and compute %."""
-    mcap_curr = trade_curr
-    if mcap_curr in ("GBp", "GBX"):
-        mcap_curr = "GBP"
-
-    if fin_curr != mcap_curr:
-        fin_rate = fx_rates.get(fin_curr, 1)
-        mcap_rate = fx_rates.get(mcap_curr, 1)
-        if fin_rate > 0 and mcap_rate > 0:
-            net_val = net_val / fin_rate * mcap_rate
-
-    pct = (net_val / market_cap) * 100
-    return round(max(0, min(pct, 100)), 4)
-
-
-def compute_zakaatable_pcts(company_data, fx_rates):
-    """Compute strict, broad, and assets-only zakaatable % for a company.
-    Returns (strict_pct, broad_pct, assets_only_pct)."""
-    if company_data.get("fallback"):
-        fb = company_data.get("zakaatable_pct", 25.0)
-        return fb, fb, fb
-
-    market_cap = company_data.get("market_cap", 0)
-    if not market_cap or market_cap <= 0:
-        return 25.0, 25.0, 25.0
-
-    fin_curr = company_data.get("financial_currency", "USD")
-    trade_curr = company_data.get("trading_currency", "USD")
-
-    net_strict = company_data.get("net_zakaatable", 0)
-    net_broad = company_data.get("net_zakaatable_broad", net_strict)
-    assets_only = company_data.get(
-        "net_zakaatable_assets_only",
-        company_data.get("assets_broad", {}).get(
-            "total",
-            company_data.get("assets", {}).get("total", net_broad),
-        ),
-    )
+def _mcap_currency(trade_curr):
+    """Market caps of pence-quoted listings are reported in GBP."""
+    return "GBP" if trade_curr in ("GBp", "GBX") else trade_curr
+
+
+def _fx_factor(fin_curr, mcap_curr, fx_rates):
+    """Multiplier converting an amount from fin_curr to mcap_curr (1.0 if either rate is unusable)."""
+    fin_rate = fx_rates.get(fin_curr, 1)
+    mcap_rate = fx_rates.get(mcap_curr, 1)
+    if fin_rate > 0 and mcap_rate > 0:
+        return mcap_rate / fin_rate
+    return 1.0
+
+
+def compute_zakaatable_pcts_batch(companies, fx_rates):
+    """Compute strict, broad, and assets-only zakaatable % for many companies at once.
+    Each amount is converted to the market cap currency, divided by market cap and
+    clipped to [0, 100]. Fallback companies keep their fallback %, and a missing
+    market cap gives the 25% estimate.
+    Returns (strict_pcts, broad_pcts, assets_only_pcts) as float64 arrays."""
+    n = len(companies)
+    fallback = np.zeros(n, dtype=bool)
+    fallback_pcts = np.full(n, 25.0)
+    mcaps = np.zeros(n)
+    factors = np.ones(n)  # fin currency -> market cap currency
+    factor_table = {}  # (fin_curr, mcap_curr) -> factor, so each pair is resolved once
+    amounts = np.zeros((3, n))  # rows: strict, broad, assets-only
+
+    for i, c in enumerate(companies):
+        if c.get("fallback"):
+            fallback[i] = True
+            fallback_pcts[i] = c.get("zakaatable_pct", 25.0)
+            continue
+
+        mcaps[i] = c.get("market_cap") or 0
+        fin_curr = c.get("financial_currency", "USD")
+        mcap_curr = _mcap_currency(c.get("trading_currency", "USD"))
+        if fin_curr != mcap_curr:
+            pair = (fin_curr, mcap_curr)
+            factor = factor_table.get(pair)
+            if factor is None:
+                factor = factor_table[pair] = _fx_factor(fin_curr, mcap_curr, fx_rates)
+            factors[i] = factor
+
+        net_strict = c.get("net_zakaatable", 0)
+        net_broad = c.get("net_zakaatable_broad", net_strict)
+        amounts[0, i] = net_strict
+        amounts[1, i] = net_broad
+        amounts[2, i] = c.get(
+            "net_zakaatable_assets_only",
+            c.get("assets_broad", {}).get(
+                "total",
+                c.get("assets", {}).get("total", net_broad),
+            ),
+        )
+
+    has_mcap = mcaps > 0
+    pcts = np.clip(amounts * factors / np.where(has_mcap, mcaps, 1.0) * 100, 0, 100).round(4)
+    pcts = np.where(fallback | ~has_mcap, np.where(fallback, fallback_pcts, 25.0), pcts)
+
+    return pcts[0], pcts[1], pcts[2]
+
+
+PCT_METHODS = ("pct_strict", "pct_broad", "pct_assets_only")
 
-    pct_strict = _convert_and_calc_pct(net_strict, market_cap, fin_curr, trade_curr, fx_rates)
-    pct_broad = _convert_and_calc_pct(net_broad, market_cap, fin_curr, trade_curr, fx_rates)
-    pct_assets_only = _convert_and_calc_pct(assets_only, market_cap, fin_curr, trade_curr, fx_rates)
 
-    return pct_strict, pct_broad, pct_assets_only
+def holdings_to_soa(holdings, companies, fx_rates):
+    """Structure-of-arrays view of a holdings list: parallel float64 arrays of
+    weights and per-method zakaatable %, indexed like holdings."""
+    soa = {"weights": np.array([h.get("weight", 0) for h in holdings], dtype=np.float64)}
+    soa.update(zip(PCT_METHODS, compute_zakaatable_pcts_batch(companies, fx_rates)))
+    return soa
 
 
-def compute_pension_data(fund_holdings, balance_sheets, fx_rates):
+def weighted_fund_pcts(soa):
+    """Weight-average each method's company % into a fund-level % (before cash).
+    One (3, N) @ (N,) product replaces three Python sums over the holdings."""
+    return np.vstack([soa[m] for m in PCT_METHODS]) @ soa["weights"] * 0.01
+
+
+def compute_pension_data(fund_holdings, balance_sheets, fx_rates, run_timestamp):
     """Compute zakaatable data for all pension fund holdings."""
-    print("\n[3/4] Computing zakaatable percentages...")
+    logger.info("\n[3/4] Computing zakaatable percentages...")
 
-    results = []
-    for h in fund_holdings["holdings"]:
-        ticker = h["ticker"]
-        bs_data = balance_sheets.get(ticker, {})
+    holdings = fund_holdings["holdings"]
+    companies = [balance_sheets.get(h["ticker"], {}) for h in holdings]
+    holdings_soa = holdings_to_soa(holdings, companies, fx_rates)
 
-        pct_strict, pct_broad, pct_assets_only = compute_zakaatable_pcts(bs_data, fx_rates)
+    # Compute fund-level zakaatable %
+    cash_contrib = fund_holdings["fund_cash_pct"]  # cash is 100% zakaatable
+    fund_pct_strict, fund_pct_broad, fund_pct_assets_only = (
+        weighted_fund_pcts(holdings_soa) + cash_contrib
+    ).tolist()
+
+    # Marshal back to per-holding dicts only for output
+    results = [None] * len(holdings)
+    for i, (h, bs_data, pct_strict, pct_broad, pct_assets_only) in enumerate(zip(
+        holdings, companies, *(holdings_soa[m].tolist() for m in PCT_METHODS)
+    )):
+        ticker = h["ticker"]
 
-        entry = {
+        results[i] = {
             "name": h["name"],
             "ticker": ticker,
             "country": h["country"],
@@ -383,20 +681,15 @@ def compute_pension_data(fund_holdings, balance_sheets, fx_rates):
                 ),
             ),
         }
-        results.append(entry)
 
-        status = "FALLBACK" if entry["fallback"] else "OK"
-        print(
-            f"  {h['name']:<40} weight={h['weight']:5.2f}%  "
-            f"strict={pct_strict:6.2f}%  broad={pct_broad:6.2f}%  assets_only={pct_assets_only:6.2f}%  [{status}]"
+    for r in results:
+        status = "FALLBACK" if r["fallback"] else "OK"
+        logger.info(
+            f"  {r['name']:<40} weight={r['weight']:5.2f}%  "
+            f"strict={r['zakaatable_pct']:6.2f}%  broad={r['zakaatable_pct_broad']:6.2f}%  "
+            f"assets_only={r['zakaatable_pct_assets_only']:6.2f}%  [{status}]"
         )
 
-    # Compute fund-level zakaatable %
-    cash_contrib = fund_holdings["fund_cash_pct"]  # cash is 100% zakaatable
-    fund_pct_strict = sum(r["weight"] * r["zakaatable_pct"] / 100 for r in results) + cash_contrib
-    fund_pct_broad = sum(r["weight"] * r["zakaatable_pct_broad"] / 100 for r in results) + cash_contrib
-    fund_pct_assets_only = sum(r["weight"] * r["zakaatable_pct_assets_only"] / 100 for r in results) + cash_contrib
-
     pension_data = {
         "fund_name": fund_holdings["fund_name"],
         "benchmark": fund_holdings["benchmark"],
@@ -405,32 +698,34 @@ def compute_pension_data(fund_holdings, balance_sheets, fx_rates):
         "fund_zakaatable_pct": round(fund_pct_strict, 4),
         "fund_zakaatable_pct_broad": round(fund_pct_broad, 4),
         "fund_zakaatable_pct_assets_only": round(fund_pct_assets_only, 4),
-        "computed_at": datetime.utcnow().isoformat() + "Z",
+        "computed_at": run_timestamp,
         "holdings": results,
     }
 
     out_path = DATA_DIR / "pension_zakat.json"
-    with open(out_path, "w") as f:
-        json.dump(pension_data, f, indent=2)
+    write_json(out_path, pension_data)
 
-    print(
+    logger.info(
         "\n  Fund zakaatable %:  "
         f"strict={fund_pct_strict:.4f}%  broad={fund_pct_broad:.4f}%  assets_only={fund_pct_assets_only:.4f}%"
     )
-    print(f"  (vs common 25% estimate)")
-    print(f"  Saved to {out_path}")
+    logger.info("  (vs common 25% estimate)")
+    logger.info(f"  Saved to {out_path}")
 
     return pension_data
 
 
-def compute_isa_data(isa_holdings, balance_sheets, fx_rates):
+def compute_isa_data(isa_holdings, balance_sheets, fx_rates, run_timestamp):
     """Compute zakaatable data for ISA holdings."""
-    results = []
-    for h in isa_holdings["holdings"]:
+    holdings = isa_holdings["holdings"]
+    companies = [balance_sheets.get(h["ticker"], {}) for h in holdings]
+    holdings_soa = holdings_to_soa(holdings, companies, fx_rates)
+
+    results = [None] * len(holdings)
+    for i, (h, bs_data, pct_strict, pct_broad, pct_assets_only) in enumerate(zip(
+        holdings, companies, *(holdings_soa[m].tolist() for m in PCT_METHODS)
+    )):
         ticker = h["ticker"]
-        bs_data = balance_sheets.get(ticker, {})
-
-        pct_strict, pct_broad, pct_assets_only = compute_zakaatable_pcts(bs_data, fx_rates)
 
         # Get current price and convert to GBP
         current_price = bs_data.get("current_price", 0)
@@ -447,7 +742,7 @@ def compute_isa_data(isa_holdings, balance_sheets, fx_rates):
         if trade_curr in ("GBp", "GBX"):
             price_gbp = current_price / 100
 
-        entry = {
+        results[i] = {
             "name": h["name"],
             "ticker": ticker,
             "zakaatable_pct": pct_strict,
@@ -474,18 +769,16 @@ def compute_isa_data(isa_holdings, balance_sheets, fx_rates):
                 ),
             ),
         }
-        results.append(entry)
 
     isa_data = {
-        "computed_at": datetime.utcnow().isoformat() + "Z",
+        "computed_at": run_timestamp,
         "holdings": results,
     }
 
     out_path = DATA_DIR / "isa_zakat.json"
-    with open(out_path, "w") as f:
-        json.dump(isa_data, f, indent=2)
+    write_json(out_path, isa_data)
 
-    print(f"\n  ISA data saved to {out_path}")
+    logger.info(f"\n  ISA data saved to {out_path}")
     return isa_data
 
 
@@ -493,82 +786,120 @@ def compute_isa_data(isa_holdings, balance_sheets, fx_rates):
 # 4. HTML GENERATION
 # ──────────────────────────────────────────────
 
-def build_pension_html(pension_data):
-    """Generate pension.html with embedded data."""
-    json_str = json.dumps(pension_data, indent=2)
+@functools.lru_cache(maxsize=None)
+def _load_template(template_path, marker):
+    """Read a template once and split it around its data marker -> (head, tail)."""
+    head, found, tail = template_path.read_text(encoding="utf-8").partition(marker)
+    if not found:
+        raise ValueError(f"{marker} not found in {template_path}")
+    return head, tail
 
-    template_path = BASE_DIR / "pension_template.html"
-    with open(template_path, "r", encoding="utf-8") as f:
-        template = f.read()
 
-    html = template.replace("/* __PENSION_DATA__ */", json_str)
+def _render_page(template_name, marker, data, out_name):
+    """Write the template with data embedded at marker, streaming the pieces to disk."""
+    head, tail = _load_template(BASE_DIR / template_name, marker)
+    # Compact: the page only parses this, nobody reads it
+    json_str = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode()
 
-    out_path = BASE_DIR / "pension.html"
+    out_path = BASE_DIR / out_name
     with open(out_path, "w", encoding="utf-8") as f:
-        f.write(html)
-    print(f"  Built {out_path}")
+        f.write(head)
+        f.write(json_str)
+        f.write(tail)
+    logger.info(f"  Built {out_path}")
 
 
-def build_isa_html(isa_data):
-    """Generate isa.html with embedded data."""
-    json_str = json.dumps(isa_data, indent=2)
-
-    template_path = BASE_DIR / "isa_template.html"
-    with open(template_path, "r", encoding="utf-8") as f:
-        template = f.read()
+def build_pension_html(pension_data):
+    """Generate pension.html with embedded data."""
+    _render_page("pension_template.html", "/* __PENSION_DATA__ */", pension_data, "pension.html")
 
-    html = template.replace("/* __ISA_DATA__ */", json_str)
 
-    out_path = BASE_DIR / "isa.html"
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write(html)
-    print(f"  Built {out_path}")
+def build_isa_html(isa_data):
+    """Generate isa.html with embedded data."""
+    _render_page("isa_template.html", "/* __ISA_DATA__ */", isa_data, "isa.html")
 
 
 # ──────────────────────────────────────────────
 # MAIN
 # ──────────────────────────────────────────────
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Zakat calculator data pipeline")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignore cached responses and fetch everything live")
+    parser.add_argument("--refresh", action="append", default=[], metavar="TICKER",
+                        help="re-fetch this ticker even if cached (repeatable)")
+    return parser.parse_args(argv)
+
+
+def start_logging():
+    """Send pipeline output through a queue drained by one background thread,
+    so fetch workers never block on stdout. Returns the started listener."""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, handler)
+
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener.start()
+    return listener
+
+
 def main():
-    print("=" * 60)
-    print("  ZAKAT CALCULATOR - DATA PIPELINE")
-    print("=" * 60)
+    args = parse_args()
+    CACHE.enabled = not args.no_cache
+    CACHE.refresh = set(args.refresh)
+
+    # One UTC timestamp for every output of this run
+    run_timestamp = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+    listener = start_logging()
+    try:
+        run_pipeline(run_timestamp)
+    finally:
+        listener.stop()  # flushes any queued lines
+
+
+def run_pipeline(run_timestamp):
+    logger.info("=" * 60)
+    logger.info("  ZAKAT CALCULATOR - DATA PIPELINE")
+    logger.info("=" * 60)
 
     # Load holdings
-    with open(DATA_DIR / "fund_holdings.json") as f:
-        fund_holdings = json.load(f)
-    with open(DATA_DIR / "isa_holdings.json") as f:
-        isa_holdings = json.load(f)
+    fund_holdings = read_json(DATA_DIR / "fund_holdings.json")
+    isa_holdings = read_json(DATA_DIR / "isa_holdings.json")
 
     # Collect unique tickers
     fund_tickers = [h["ticker"] for h in fund_holdings["holdings"]]
     isa_tickers = [h["ticker"] for h in isa_holdings["holdings"]]
     all_tickers = list(dict.fromkeys(fund_tickers + isa_tickers))  # dedupe, preserve order
 
-    print(f"\n  Fund holdings: {len(fund_holdings['holdings'])}")
-    print(f"  ISA holdings:  {len(isa_holdings['holdings'])}")
-    print(f"  Unique tickers: {len(all_tickers)}")
+    logger.info(f"\n  Fund holdings: {len(fund_holdings['holdings'])}")
+    logger.info(f"  ISA holdings:  {len(isa_holdings['holdings'])}")
+    logger.info(f"  Unique tickers: {len(all_tickers)}")
 
-    # Step 1: FX rates
-    fx_rates = fetch_fx_rates()
+    # Step 1: FX rates (a single request, fetched first so an FX outage fails fast)
+    fx_rates = fetch_fx_rates(run_timestamp)
 
     # Step 2: Balance sheets
     balance_sheets = fetch_all_balance_sheets(all_tickers)
 
     # Step 3: Compute zakat
-    pension_data = compute_pension_data(fund_holdings, balance_sheets, fx_rates)
-    isa_data = compute_isa_data(isa_holdings, balance_sheets, fx_rates)
+    pension_data = compute_pension_data(fund_holdings, balance_sheets, fx_rates, run_timestamp)
+    isa_data = compute_isa_data(isa_holdings, balance_sheets, fx_rates, run_timestamp)
 
     # Step 4: Build HTML
-    print("\n[4/4] Building HTML files...")
+    logger.info("\n[4/4] Building HTML files...")
     build_pension_html(pension_data)
     build_isa_html(isa_data)
 
-    print("\n" + "=" * 60)
-    print("  COMPLETE")
-    print(f"  Fund zakaatable: {pension_data['fund_zakaatable_pct']:.2f}%")
-    print(f"  Open pension.html and isa.html in your browser")
-    print("=" * 60)
+    logger.info("\n" + "=" * 60)
+    logger.info("  COMPLETE")
+    logger.info(f"  Fund zakaatable: {pension_data['fund_zakaatable_pct']:.2f}%")
+    logger.info("  Open pension.html and isa.html in your browser")
+    logger.info("=" * 60)
 
 
 if __name__ == "__main__":